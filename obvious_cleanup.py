@@ -16,46 +16,223 @@ Cleans up simple obvious messy stuff:
 """
 
 import argparse
+import os
 import re
-import sys
-from functools import wraps
+from functools import lru_cache
 
-from fissix.fixer_util import parenthesize
+from fissix import patcomp
 from fissix.pygram import python_symbols as syms
 
-from bowler import Query, TOKEN, SYMBOL
-from bowler.types import Leaf, Node, STARS
+from bowler import Query, TOKEN
+from bowler.types import Leaf, Node
 
 flags = {}
 
 
-def kw(name, **kwargs):
+# fissix recompiles every fixer's PATTERN string each time a Query is
+# executed. Compiled patterns are stateless, so memoize them by source
+# string; repeated main() calls in one process then reuse the compiled
+# matcher instead of re-parsing the pattern grammar.
+_original_compile_pattern = patcomp.PatternCompiler.compile_pattern
+
+
+@lru_cache(maxsize=64)
+def _compile_pattern_cached(input, with_tree):
+    return _original_compile_pattern(
+        patcomp.PatternCompiler(), input, with_tree=with_tree
+    )
+
+
+def _compile_pattern(self, input, debug=False, with_tree=False):
+    if debug:
+        return _original_compile_pattern(self, input, debug, with_tree)
+    return _compile_pattern_cached(input, with_tree)
+
+
+patcomp.PatternCompiler.compile_pattern = _compile_pattern
+
+
+# PATTERN strings are compiled into pattern-grammar trees by bowler/fissix,
+# which is relatively expensive. Build them once at import time so drivers
+# that call main() repeatedly don't pay for recompilation.
+
+# 'not a == b' --> 'a != b'
+NOT_PATTERN = '''
+    not_test<
+        "not" comparison=comparison< any* >
+    >
+'''
+
+# 'a == None' --> 'a is None'
+NONE_PATTERN = '''
+    comparison<
+        ( a=any op=( "==" | "!=" ) none="None" )
+        | ( none="None" op=( "==" | "!=" ) a=any )
+    >
+'''
+
+# Fragments shared between the comprehension patterns below.
+FORLOOP_FRAG = '''forloop=(
+    comp_for< any* "in" any [ ifpart=comp_if< any* > ] >
+)'''
+
+KV_FRAG = '''kv=atom< "(" testlist_gexp< k=any "," v=any > ")" >'''
+
+# dict([(a, b) for (a, b) in x])
+# dict((a, b) for (a, b) in x)
+# dict(((a, b) for (a, b) in x))
+# --> {a: b for (a, b) in x}
+DICT_COMP_PATTERN = f"""
+    power< "dict" trailer< '(' (
+        atom< "[" listmaker< {KV_FRAG} {FORLOOP_FRAG} > "]" >
+        | argument< {KV_FRAG} {FORLOOP_FRAG} >
+        | atom< "(" testlist_gexp< {KV_FRAG} {FORLOOP_FRAG} > ")" >
+    ) ')' > >
     """
-    A helper to produce keyword nodes
+
+# set([a for a in x])
+# set((a for a in x))
+# set(a for a in x)
+# --> {a for a in x}
+#
+# TODO
+# set([x, y, z])
+# set((x, y, z))
+# --> {x, y, z}
+SET_COMP_PATTERN = f"""
+    power< "set" trailer< '(' (
+        atom< "[" listmaker< arg=any {FORLOOP_FRAG} > "]" >
+        | argument< arg=any {FORLOOP_FRAG} >
+        | atom< "(" testlist_gexp< arg=any {FORLOOP_FRAG} > ")" >
+    ) ')' > >
     """
-    kwargs.setdefault('prefix', ' ')
-    return Leaf(TOKEN.NAME, name, **kwargs)
-
-
-OPERATOR_INVERSIONS = {
-    '==': Leaf(TOKEN.NOTEQUAL, '!=', prefix=' '),
-    '!=': Leaf(TOKEN.EQEQUAL, '==', prefix=' '),
-    '<': Leaf(TOKEN.GREATEREQUAL, '>=', prefix=' '),
-    '>': Leaf(TOKEN.LESSEQUAL, '<=', prefix=' '),
-    '<=': Leaf(TOKEN.GREATER, '>', prefix=' '),
-    '>=': Leaf(TOKEN.LESS, '<', prefix=' '),
-    'in': Node(syms.comp_op, [kw('not'), kw('in')], prefix=' '),
-    'not in': kw('in'),
-    'is': Node(syms.comp_op, [kw('is'), kw('not')], prefix=' '),
-    'is not': kw('is'),
+
+# (a)
+# --> a
+# func((x for x in y))
+# --> func(x for x in y)
+PAREN_PATTERN = """
+    (
+        assignment_form=expr_stmt<
+            any
+            "="
+            outer=atom<
+                "("
+                inner=any
+                ")"
+            >
+        >
+        |
+        outer=atom<
+            "("
+            inner=(NAME | NUMBER | STRING | factor | atom< "(" any ")" >)
+            ")"
+        >
+        |
+        any<
+            "("
+            outer=atom<
+                "("
+                inner=testlist_gexp<
+                    any
+                    comp_for
+                >
+                ")"
+            >
+            ")"
+        >
+    )
+"""
+
+# All five rewrites fused into a single top-level alternation, so the tree
+# is walked once instead of once per selector. The kind_* capture names tag
+# which alternative matched, for dispatch in cleanup().
+CLEANUP_PATTERN = f"""
+    (
+        kind_not={NOT_PATTERN}
+        |
+        kind_none={NONE_PATTERN}
+        |
+        kind_dictcomp={DICT_COMP_PATTERN}
+        |
+        kind_setcomp={SET_COMP_PATTERN}
+        |
+        kind_paren={PAREN_PATTERN}
+    )
+"""
+
+
+# Cheap textual prefilter: parsing a file into a CST is by far the dominant
+# cost, so skip files that can't possibly contain any of the patterns above.
+# Deliberately loose — false positives just mean a wasted parse.
+_TRIGGER_RE = re.compile(
+    r'''
+    \bnot\b                 # not a == b
+    | [=!]=[\s\\]*None\b    # a == None (tolerating line continuations)
+    | \bNone[\s\\]*[=!]=    # None == a
+    | \bdict\s*\(           # dict(...) comprehensions
+    | \bset\s*\(            # set(...) comprehensions
+    # The paren rule only fires when both parens are on one line, but its
+    # assignment form accepts any inner expression, so anything cleverer
+    # than "a same-line pair of parens" risks skipping files the tool
+    # would rewrite. A false positive only costs a parse.
+    | \([^\n]*\)
+    ''',
+    re.VERBOSE,
+)
+
+
+# Shared keyword Leaf templates; clone only when actually attaching to a
+# tree, rather than allocating a fresh Leaf at every use.
+_KW_NOT = Leaf(TOKEN.NAME, 'not', prefix=' ')
+_KW_IN = Leaf(TOKEN.NAME, 'in', prefix=' ')
+_KW_IS = Leaf(TOKEN.NAME, 'is', prefix=' ')
+
+
+# Factories rather than template nodes: building a minimal subtree directly
+# is cheaper than the recursive child-by-child copy done by Leaf/Node.clone().
+OPERATOR_INVERSION_FACTORIES = {
+    '==': lambda: Leaf(TOKEN.NOTEQUAL, '!=', prefix=' '),
+    '!=': lambda: Leaf(TOKEN.EQEQUAL, '==', prefix=' '),
+    '<': lambda: Leaf(TOKEN.GREATEREQUAL, '>=', prefix=' '),
+    '>': lambda: Leaf(TOKEN.LESSEQUAL, '<=', prefix=' '),
+    '<=': lambda: Leaf(TOKEN.GREATER, '>', prefix=' '),
+    '>=': lambda: Leaf(TOKEN.LESS, '<', prefix=' '),
+    'in': lambda: Node(syms.comp_op, [_KW_NOT.clone(), _KW_IN.clone()], prefix=' '),
+    'not in': lambda: _KW_IN.clone(),
+    'is': lambda: Node(syms.comp_op, [_KW_IS.clone(), _KW_NOT.clone()], prefix=' '),
+    'is not': lambda: _KW_IS.clone(),
 }
 
 
 def invert_operator(op):
-    return OPERATOR_INVERSIONS[str(op).strip()].clone()
+    # Read the token value(s) directly rather than str(op).strip(), which
+    # renders the whole node (prefix included) just to strip it off again.
+    if isinstance(op, Leaf):
+        key = op.value
+    else:
+        # multi-token operators: 'not in', 'is not'
+        key = ' '.join(child.value for child in op.children)
+    return OPERATOR_INVERSION_FACTORIES[key]()
+
+
+def _retype_node(node, new_type):
+    """
+    Return a new Node of the given type, reusing node's children.
+
+    Mutating node.type in place works today but isn't a supported fissix
+    operation; constructing the right node directly is explicit and avoids
+    any revalidation of cached tree state.
+    """
+    # a childless Node reports an empty prefix, so read it before detaching
+    prefix = node.prefix
+    children = list(node.children)
+    for child in children:
+        child.remove()
+    return Node(new_type, children, prefix=prefix)
 
 
-def simplify_not_operators(node, capture, arguments):
+def simplify_not_operators(node, comparison):
     """
     not a == b
         --> a != b
@@ -67,28 +244,30 @@ def simplify_not_operators(node, capture, arguments):
     a is b
     """
     # invert the operator
-    op = capture['comparison'].children[1]
+    op = comparison.children[1]
     op.replace(invert_operator(op))
-    # remove the 'not'
-    rest = node.children[1].clone()
+    # remove the 'not'. The old node is discarded wholesale, so detach the
+    # comparison and reuse it rather than cloning the whole subtree.
+    rest = node.children[1]
+    rest.remove()
     rest.prefix = node.prefix
     node.replace(rest)
 
 
-def simplify_none_operand(node, capture, arguments):
+def simplify_none_operand(op):
     """
     a != None
         --> a is not None
     """
-    op = capture['op'][0]
-    print(op)
+    if flags.get('debug'):
+        print(op)
     if op.type == TOKEN.EQEQUAL:
-        op.replace(kw('is'))
+        op.replace(_KW_IS.clone())
     else:
-        op.replace(Node(syms.comp_op, [kw('is'), kw('not')]))
+        op.replace(Node(syms.comp_op, [_KW_IS.clone(), _KW_NOT.clone()]))
 
 
-def make_dict_comprehension(node, capture, arguments):
+def make_dict_comprehension(node, kv, key, value, forloop, ifpart):
     """
     dict([(k, v) for k, v in x])
         --> {k: v for k, v in x}
@@ -108,15 +287,20 @@ def make_dict_comprehension(node, capture, arguments):
         >>> print(a)
         5
     """
-    kv = capture['kv']
-    key = capture['k']
-    value = capture['v']
-    forloop = capture['forloop'][0]
-    ifpart = capture.get('ifpart') or None
-
-    forloop.type = syms.comp_for
     if ifpart:
-        ifpart.type = syms.comp_if
+        ifpart.replace(_retype_node(ifpart, syms.comp_if))
+
+    # get_suffix() walks the tree to find the next leaf; do it exactly once
+    # and bind the parent rather than resolving kv.parent twice.
+    parent = kv.parent
+    prefix = parent.prefix
+    suffix = parent.get_suffix()
+
+    # The whole node is replaced, so the pieces we keep can be detached and
+    # reparented as-is instead of cloned.
+    key.remove()
+    value.remove()
+    forloop = _retype_node(forloop, syms.comp_for)
 
     node.replace(
         Node(
@@ -126,28 +310,30 @@ def make_dict_comprehension(node, capture, arguments):
                 Node(
                     syms.dictsetmaker,
                     [
-                        key.clone(),
+                        key,
                         Leaf(TOKEN.COLON, ":"),
-                        value.clone(),
-                        forloop.clone(),
+                        value,
+                        forloop,
                     ],
-                    prefix=kv.parent.prefix,
+                    prefix=prefix,
                 ),
-                Leaf(TOKEN.RBRACE, "}", prefix=kv.parent.get_suffix()),
+                Leaf(TOKEN.RBRACE, "}", prefix=suffix),
             ],
             prefix=node.prefix,
         )
     )
 
 
-def make_set_comprehension(node, capture, arguments):
-    arg = capture['arg']
-    forloop = capture['forloop'][0]
-    ifpart = capture.get('ifpart') or None
-
-    forloop.type = syms.comp_for
+def make_set_comprehension(node, arg, forloop, ifpart):
     if ifpart:
-        ifpart.type = syms.comp_if
+        ifpart.replace(_retype_node(ifpart, syms.comp_if))
+
+    parent = arg.parent
+    prefix = parent.prefix
+    suffix = parent.get_suffix()
+
+    arg.remove()
+    forloop = _retype_node(forloop, syms.comp_for)
 
     node.replace(
         Node(
@@ -156,28 +342,24 @@ def make_set_comprehension(node, capture, arguments):
                 Leaf(TOKEN.LBRACE, "{"),
                 Node(
                     syms.dictsetmaker,
-                    [arg.clone(), forloop.clone()],
-                    prefix=arg.parent.prefix,
+                    [arg, forloop],
+                    prefix=prefix,
                 ),
-                Leaf(TOKEN.RBRACE, "}", prefix=arg.parent.get_suffix()),
+                Leaf(TOKEN.RBRACE, "}", prefix=suffix),
             ],
             prefix=node.prefix,
         )
     )
 
 
-def remove_extra_parentheses(node, capture, arguments):
-    node = capture['outer']
-    inner = capture['inner']
-
-    if node.children[0].get_lineno() != node.children[2].get_lineno():
+def remove_extra_parentheses(node, inner, assignment_form):
+    children = node.children
+    if children[0].get_lineno() != children[2].get_lineno():
         # don't touch parentheses on separate lines. they make a lot of
         # things syntactically correct that otherwise wouldn't be.
         return
 
-    if isinstance(inner, list):
-        inner = inner[0]
-    if capture.get('assignment_form') and inner.type == syms.testlist_gexp:
+    if assignment_form and inner.type == syms.testlist_gexp:
         # a = (b,)
         # a = (b, c)
         # a = (b for c in d)
@@ -185,10 +367,53 @@ def remove_extra_parentheses(node, capture, arguments):
         # but it's not normal/best practice.
         # so we don't.
         return
-    newnode = inner.clone()
 
-    newnode.prefix = node.prefix
-    node.replace(newnode)
+    # The parenthesised atom is discarded, so reuse the inner node rather
+    # than cloning it. All the cheap rejections above happen first.
+    inner.remove()
+    inner.prefix = node.prefix
+    node.replace(inner)
+
+
+def cleanup(node, capture, arguments):
+    """
+    Dispatch to the right rewrite for whichever CLEANUP_PATTERN
+    alternative matched this node.
+
+    Extracts exactly the captures each rewrite needs and passes them
+    positionally, so the helpers don't repeat the dict lookups.
+    """
+    if 'kind_not' in capture:
+        simplify_not_operators(node, capture['comparison'])
+    elif 'kind_none' in capture:
+        op = capture['op']
+        if isinstance(op, list):
+            op = op[0]
+        simplify_none_operand(op)
+    elif 'kind_dictcomp' in capture:
+        forloop = capture['forloop']
+        if isinstance(forloop, list):
+            forloop = forloop[0]
+        make_dict_comprehension(
+            node,
+            capture['kv'],
+            capture['k'],
+            capture['v'],
+            forloop,
+            capture.get('ifpart'),
+        )
+    elif 'kind_setcomp' in capture:
+        forloop = capture['forloop']
+        if isinstance(forloop, list):
+            forloop = forloop[0]
+        make_set_comprehension(node, capture['arg'], forloop, capture.get('ifpart'))
+    elif 'kind_paren' in capture:
+        inner = capture['inner']
+        if isinstance(inner, list):
+            inner = inner[0]
+        remove_extra_parentheses(
+            capture['outer'], inner, bool(capture.get('assignment_form'))
+        )
 
 
 def main():
@@ -224,116 +449,39 @@ def main():
     # No way to pass this to .modify() callables, so we just set it at module level
     flags['debug'] = args.debug
 
+    # Don't bother parsing files that can't contain any of the patterns.
+    # Anything that isn't a regular file (e.g. a directory, which bowler
+    # walks itself) is passed through untouched.
+    eligible = []
+    for path in args.files:
+        if not os.path.isfile(path):
+            eligible.append(path)
+            continue
+        # errors='replace' so an oddly-encoded file can't abort the whole
+        # run here; bowler reports unreadable files per-file later.
+        with open(path, errors='replace') as f:
+            if _TRIGGER_RE.search(f.read()):
+                eligible.append(path)
+    if not eligible:
+        return
+
     query = (
         # Look for files in the current working directory
-        Query(*args.files)
-        # 'not a == b' --> 'a != b'
-        .select(
-            '''
-            not_test<
-                "not" comparison=comparison< any* >
-            >
-        '''
-        )
-        .modify(callback=simplify_not_operators)
-        # 'a == None' --> 'a is None'
-        .select(
-            '''
-            comparison=comparison<
-                ( a=any op=( "==" | "!=" ) none="None" )
-                | ( none="None" op=( "==" | "!=" ) a=any )
-            >
-            '''
-        )
-        .modify(callback=simplify_none_operand)
-        # dict([(a, b) for (a, b) in x])
-        # dict((a, b) for (a, b) in x)
-        # dict(((a, b) for (a, b) in x))
-        # --> {a: b for (a, b) in x}
-        .select(
-            """
-            power< "dict" trailer< '(' (
-                atom< "[" listmaker< {kv} {forloop} > "]" >
-                | argument< {kv} {forloop} >
-                | atom< "(" testlist_gexp< {kv} {forloop} > ")" >
-            ) ')' > >
-            """.format(
-                forloop='''forloop=(
-                    comp_for< any* "in" any [ ifpart=comp_if< any* > ] >
-                )''',
-                kv='''
-                    kv=atom< "(" testlist_gexp< k=any "," v=any > ")" >
-                ''',
-            )
-        )
-        .modify(callback=make_dict_comprehension)
-        # set([a for a in x])
-        # set((a for a in x))
-        # set(a for a in x)
-        # --> {a for a in x}
-        #
-        # TODO
-        # set([x, y, z])
-        # set((x, y, z))
-        # --> {x, y, z}
-        .select(
-            """
-            power< "set" trailer< '(' (
-                atom< "[" listmaker< arg=any {forloop} > "]" >
-                | argument< arg=any {forloop} >
-                | atom< "(" testlist_gexp< arg=any {forloop} > ")" >
-            ) ')' > >
-            """.format(
-                forloop='''forloop=(
-                    comp_for< any* "in" any [ ifpart=comp_if< any* > ] >
-                )'''
-            )
-        )
-        .modify(callback=make_set_comprehension)
-        # (a)
-        # --> a
-        # func((x for x in y))
-        # --> func(x for x in y)
-        .select(
-            """
-                (
-                    assignment_form=expr_stmt<
-                        any
-                        "="
-                        outer=atom<
-                            "("
-                            inner=any
-                            ")"
-                        >
-                    >
-                    |
-                    outer=atom<
-                        "("
-                        inner=(NAME | NUMBER | STRING | factor | atom< "(" any ")" >)
-                        ")"
-                    >
-                    |
-                    any<
-                        "("
-                        outer=atom<
-                            "("
-                            inner=testlist_gexp<
-                                any
-                                comp_for
-                            >
-                            ")"
-                        >
-                        ")"
-                    >
-                )
-            """
-        )
-        .modify(callback=remove_extra_parentheses)
+        Query(*eligible)
+        # All five rewrites in a single pass over each file's tree.
+        .select(CLEANUP_PATTERN)
+        .modify(callback=cleanup)
         # Actually run all of the above.
+        #
+        # Note: bowler already fans the per-file parse/rewrite work out to
+        # os.cpu_count() worker processes, so there's no need to wrap this
+        # in our own ProcessPoolExecutor.
         .execute(
             # interactive diff implies write (for the bits the user says 'y' to)
             interactive=(args.interactive and args.write),
             write=args.write,
+            # single-process mode keeps tracebacks readable when debugging
+            in_process=args.debug,
         )
     )
 